@@ -129,7 +129,7 @@ function App() {
     setQueryError('');
 
     try {
-      const res = await fetch(`${API_URL}/query`, {
+      const res = await fetch(`${API_URL}/query/stream`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -139,16 +139,50 @@ function App() {
         })
       });
 
-      const data = await res.json();
-
       if (!res.ok) {
+        const data = await res.json();
         throw new Error(data.detail || 'Query failed');
       }
 
-      setAnswer(data.answer || 'No answer generated.');
-      setSources(data.sources || []);
-      setTiming(data.timing || {});
-      setTokenEstimate(data.token_estimate || {});
+      // Parse server-sent events: "event: <name>\ndata: <json>\n\n"
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let streamedAnswer = '';
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const raw of events) {
+          const eventLine = raw.split('\n').find((l) => l.startsWith('event: '));
+          const dataLine = raw.split('\n').find((l) => l.startsWith('data: '));
+          if (!eventLine || !dataLine) continue;
+
+          const event = eventLine.slice(7);
+          const data = JSON.parse(dataLine.slice(6));
+
+          if (event === 'sources') {
+            setSources(data.sources || []);
+          } else if (event === 'token') {
+            streamedAnswer += data.content;
+            setAnswer(streamedAnswer);
+          } else if (event === 'done') {
+            setTiming(data.timing || {});
+            setTokenEstimate(data.token_estimate || {});
+          } else if (event === 'error') {
+            throw new Error(data.detail || 'Query failed');
+          }
+        }
+      }
+
+      if (!streamedAnswer) {
+        setAnswer('No answer generated.');
+      }
     } catch (err) {
       setQueryError(err.message);
       setAnswer('');